@@ -2,18 +2,53 @@
 Module for wrangling data: cleans and prepares all data sets for analysis 
 '''
 
+import functools
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import geopandas as gpd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pacsv
 
 CODE = "data/state_codes.csv"
 POPS = ["data/pop_90-99.csv", "data/pop_00-10.csv", "data/pop_10-19.csv"]
 LEG = "data/leg_90-19.csv"
 ENG = ["data/generation_annual.csv", "data/emission_annual.csv"]
 GEO = "data/shapefiles/cb_2019_us_state_500k.shp"
+POP_CACHE = "data/cache/pop.parquet"
+ENG_CACHE = "data/cache/eng.parquet"
 
 PUNCTUATION = "!@#$%^&*."
 
+#Energy measure columns, written with thousands separators. They are read 
+#as text and read_csv_arrow converts exactly these columns to integers
+ENG_NUMERIC = ["GENERATION (Megawatthours)", 
+               "CO2\n(Metric Tons)", 
+               "SO2\n(Metric Tons)", 
+               "NOx\n(Metric Tons)"]
+
+#Raw energy csv schemas, so the reader skips type inference
+ENG_TYPES = {"YEAR": pa.int64(), 
+             "STATE": pa.string(), 
+             "TYPE OF PRODUCER": pa.string(), 
+             "ENERGY SOURCE": pa.string(), 
+             "Year": pa.int64(), 
+             "State": pa.string(), 
+             "Producer Type": pa.string(), 
+             "Energy Source": pa.string(), 
+             **{col: pa.string() for col in ENG_NUMERIC}}
+
+#Source labels are whole cell values, so one lookup replaces all of them
+SOURCE_NAMES = {"Hydroelectric Conventional": "Hydroelectric",
+                "Wood and Wood Derived Fuels": "Wood Derived Fuels",
+                "Solar Thermal and Photovoltaic": "Solar"}
+
 
 # FUNCTIONS TO IMPORT AND CLEAN DATA
 def load_states(filename=GEO):
@@ -31,25 +66,66 @@ def load_states(filename=GEO):
     return gdf
 
 
-def load_codes(filename=CODE):
+@functools.lru_cache(maxsize=None)
+def read_codes(filename, mtime):
     '''
-    Imports and cleans a mapping of state names to two-letter codes
+    Reads and cleans the state codes csv, cached per filename and 
+    modification time so edits to the file are picked up
 
     Inputs: 
         filename (str): the string for the filepath
+        mtime (float): the file's modification time, used as a cache key
 
     Returns: 
-        letters (pandas df): cleaned dataframe of state codes data
+        letters (pandas df): cleaned dataframe of state codes data, shared 
+            between callers
     '''
-    letters = pd.read_csv(filename)
+    #Upper-case the codes while parsing rather than in a second column pass
+    letters = pd.read_csv(filename, usecols=["State", "Code"], 
+                          converters={"Code": str.upper})
     letters.columns = letters.columns.str.lower()
-    letters = letters[["state", "code"]]
-    
-    letters["code"] = letters["code"].str.upper()
 
     return letters
 
 
+def load_codes(filename=CODE):
+    '''
+    Imports and cleans a mapping of state names to two-letter codes. The csv
+    is only parsed again when it changes; each caller gets its own copy
+
+    Inputs: 
+        filename (str): the string for the filepath
+
+    Returns: 
+        letters (pandas df): cleaned dataframe of state codes data
+    '''
+    return read_codes(filename, os.path.getmtime(filename)).copy()
+
+
+def add_state_codes(df, letters=None):
+    '''
+    Attaches two-letter codes to a dataframe with a "state" column, keeping 
+    only the rows that match a state in letters
+
+    Inputs: 
+        df (pandas df): dataframe with a column of full state names
+        letters (pandas df): state codes data; loaded with load_codes if None
+
+    Returns: 
+        df (pandas df): the matching rows with a "code" column after "state"
+    '''
+    letters = load_codes() if letters is None else letters
+    state_to_code = dict(zip(letters["state"], letters["code"]))
+
+    df = df.copy()
+    #State names come back as object dtype, as the letters merge returned them
+    df["state"] = df["state"].astype(object)
+    df.insert(df.columns.get_loc("state") + 1, "code", 
+              df["state"].map(state_to_code))
+
+    return df.dropna(subset=["code"])
+
+
 def load_clean_pop(filename):
     '''
     Imports and cleans a census estimates dataframe
@@ -60,15 +136,16 @@ def load_clean_pop(filename):
     Returns: 
         pop_df (pandas df): cleaned dataframe of population data
     '''
-    df = pd.read_csv(filename, header=3, thousands=",")
-    df.columns = df.columns.str.lower()
-    df = df.dropna()
-
-    keep_cols = [col for col in df.columns if "-" not in col]
-    df_yrs = df[keep_cols]
-
-    states_mask = df_yrs.iloc[:, 0].str.startswith(".")
-    df_states = df_yrs.loc[states_mask, :]
+    #Skip the "YYYY-YYYY" range columns at parse time
+    df_yrs = pd.read_csv(filename, header=3, thousands=",", 
+                         usecols=lambda col: "-" not in col)
+    df_yrs.columns = df_yrs.columns.str.lower()
+
+    #State rows are the sub-parts marked with a leading dot. Filtering on them
+    #first drops the header/footer rows, so dropna only scans the states
+    states_mask = np.array([isinstance(val, str) and val[:1] == "." 
+                            for val in df_yrs.iloc[:, 0].to_numpy()], dtype=bool)
+    df_states = df_yrs.loc[states_mask, :].dropna()
     df_states.reset_index(drop=True, inplace=True)
     
     if "unnamed" in df_states.columns[0]:
@@ -79,26 +156,107 @@ def load_clean_pop(filename):
     return df_states
 
 
-def build_pop(files=POPS):
+def cache_path(cache, files):
+    '''
+    Derives the cache filepath for a set of input files, so data built from
+    different inputs never shares a cache
+
+    Inputs: 
+        cache (str): the base filepath of the parquet cache
+        files (lst): list of filepaths the cached data is built from
+
+    Returns: 
+        path (str): the base filepath with a hash of the inputs appended
+    '''
+    key = hashlib.sha1("\n".join(files).encode()).hexdigest()[:12]
+    root, ext = os.path.splitext(cache)
+
+    return f"{root}_{key}{ext}"
+
+
+def load_cache(cache, files):
+    '''
+    Loads a cleaned dataframe saved by save_cache, as long as it is newer 
+    than every file it was built from and than this module
+
+    Inputs: 
+        cache (str): the base filepath of the parquet cache, or None to skip it
+        files (lst): list of filepaths the cached data was built from
+
+    Returns: 
+        df (pandas df): the cached dataframe, or None if missing or stale
+    '''
+    if cache is None:
+        return None
+
+    path = cache_path(cache, files)
+    if not os.path.exists(path):
+        return None
+
+    sources = list(files) + [__file__]
+    if os.path.getmtime(path) <= max(os.path.getmtime(f) for f in sources):
+        return None
+
+    #A damaged cache is rebuilt rather than failing the whole pipeline
+    try:
+        return pd.read_parquet(path)
+    except (OSError, pa.ArrowException):
+        return None
+
+
+def save_cache(df, cache, files):
+    '''
+    Saves a cleaned dataframe to parquet so later runs can skip the csvs
+
+    Inputs: 
+        df (pandas df): the cleaned dataframe
+        cache (str): the base filepath of the parquet cache, or None to skip it
+        files (lst): list of filepaths the data was built from
+    '''
+    if cache is None:
+        return
+
+    path = cache_path(cache, files)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    #Write to a temp file and swap it in, so an interrupted run never leaves
+    #a partial cache that looks newer than its sources
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def build_pop(files=POPS, cache=POP_CACHE):
     '''
     Loads, cleans, and merges all three population data sets
 
     Inputs: 
         files (lst): list of filepaths for the three data sets (constant)
-        codes (str): the filepath to the state codes data
+        cache (str): base parquet filepath for the cleaned data, or None to 
+            always rebuild
 
     Returns:
         pop_df (pandas df): a dataframe of population data from 1990-2019
     '''
-    letters = load_codes()
-    pop_df = load_clean_pop(files[0])
+    #State codes come from the cached load_codes, so they are a cache input
+    sources = list(files) + [CODE]
+
+    pop_df = load_cache(cache, sources)
+    if pop_df is not None:
+        return pop_df
 
-    for filename in files[1:]:
-        df = load_clean_pop(filename)
-        pop_df = pop_df.merge(df, how="inner", on="state")
+    frames = [load_clean_pop(filename).set_index("state") for filename in files]
 
-    pop_df["state"] = pop_df["state"].str.strip(PUNCTUATION)
-    pop_df = letters.merge(pop_df, how="inner", on="state")
+    #Frames share the same states with disjoint year columns, so align on index
+    pop_df = pd.concat(frames, axis=1, join="inner").reset_index()
+
+    pop_df["state"] = [val.strip(PUNCTUATION) for val in pop_df["state"].to_numpy()]
+    pop_df = add_state_codes(pop_df)
 
     drop_cols = [col for col in pop_df.columns if \
                  col != "state" and len(col) > 4]
@@ -109,13 +267,15 @@ def build_pop(files=POPS):
                                      col not in ["state", "code"]])
     
     pop_df = pop_df.rename(columns={"variable": "year", "value": "pop"})
+    save_cache(pop_df, cache, sources)
 
     return pop_df
 
 
 def load_clean_pol(filename=LEG):
     '''
-    Loads and cleans a data set with energy data
+    Loads and cleans a data set with energy data. Rows are not matched to 
+    state codes here; use add_state_codes when joining with other data
 
     Inputs: 
         filename (str): the string for the filepath
@@ -123,28 +283,62 @@ def load_clean_pol(filename=LEG):
     Returns: 
         pol_df (pandas df): cleaned dataframe of power generation data  
     '''
-    letters = load_codes()
-
-    df = pd.read_csv(filename)
+    #Every column holds text (state names and party labels). Plain python
+    #strings suit the list comprehension below, which would otherwise have 
+    #to box each arrow value
+    df = pd.read_csv(filename, dtype=str)
     df.columns = df.columns.str.lower()
 
+    #One pass per column instead of chained .str calls
     for col in [col for col in df.columns if col != "state"]:
-        df[col] = df[col].str.strip(PUNCTUATION)
-        df[col] = df[col].str.replace("Divided", "Split")
+        df[col] = [val.strip(PUNCTUATION).replace("Divided", "Split") 
+                   if isinstance(val, str) else val for val in df[col]]
 
-    pol_df = letters.merge(df, how="inner", on="state")
     #Nebraska has a unicameral legislature, so I am including it as split
-    pol_df.fillna("Split", inplace=True)
+    pol_df = df.dropna(subset=["state"]).fillna("Split")
 
-    pol_df = pol_df.melt(id_vars=["state", "code"], 
+    pol_df = pol_df.melt(id_vars=["state"], 
                          value_vars=[col for col in pol_df.columns if 
-                                     col not in ["state", "code"]])
+                                     col != "state"])
     
     pol_df = pol_df.rename(columns={"variable": "year", "value": "pol"})
 
     return pol_df
 
 
+def read_csv_arrow(filename, column_types=None, thousands_cols=()):
+    '''
+    Reads a csv with pyarrow's multithreaded reader, parsing the given 
+    columns of quoted numbers with thousands separators (e.g. "1,234") as 
+    integers and keeping text columns as arrow-backed strings
+
+    Inputs: 
+        filename (str): the string for the filepath
+        column_types (dict): optional map of column names to arrow types; 
+            names not in the file are ignored
+        thousands_cols (iterable): names of columns to convert to integers; 
+            names not in the file are ignored. Blank cells become missing 
+            values and any other non-integer cell raises pa.ArrowInvalid
+
+    Returns: 
+        df (pandas df): dataframe of the raw csv data
+    '''
+    convert = pacsv.ConvertOptions(column_types=column_types or {})
+    tbl = pacsv.read_csv(filename, convert_options=convert)
+
+    for name in thousands_cols:
+        i = tbl.schema.get_field_index(name)
+        if i == -1:
+            continue
+        col = pc.replace_substring(tbl.column(i).cast(pa.string()), ",", "")
+        col = pc.if_else(pc.equal(col, ""), pa.scalar(None, pa.string()), col)
+        tbl = tbl.set_column(i, name, col.cast(pa.int64()))
+
+    arrow_strings = {pa.string(): pd.StringDtype("pyarrow")}
+
+    return tbl.to_pandas(types_mapper=arrow_strings.get)
+
+
 def load_clean_eng(filename):
     '''
     Loads and cleans a data set with energy data
@@ -155,10 +349,9 @@ def load_clean_eng(filename):
     Returns: 
         eng_df (pandas df): cleaned dataframe of power generation data
     '''
-    df = pd.read_csv(filename, thousands=",")
-    df.columns = df.columns.str.lower()
-    df.columns = df.columns.str.replace(" ", "_", regex=True)
-    df.columns = df.columns.str.replace(r"\n", "_", regex=True)
+    df = read_csv_arrow(filename, column_types=ENG_TYPES, 
+                        thousands_cols=ENG_NUMERIC)
+    df.columns = df.columns.str.lower().str.replace(r"[ \n]", "_", regex=True)
 
     if "generation" in filename:
         df = df.rename(columns={"energy_source": "src", 
@@ -185,33 +378,59 @@ def load_clean_eng(filename):
     eng_df = df.loc[totals_mask, keep_cols]
     eng_df.reset_index(drop=True, inplace=True)
 
-    eng_df["src"] = eng_df["src"].str.replace("Hydroelectric Conventional", 
-                                              "Hydroelectric", regex=True)
-    eng_df["src"] = eng_df["src"].str.replace("Wood and Wood Derived Fuels", 
-                                              "Wood Derived Fuels", regex=True)
-    eng_df["src"] = eng_df["src"].str.replace("Solar Thermal and Photovoltaic", 
-                                              "Solar", regex=True)
+    #Rename before categorizing, so an old label and its new name merge 
+    #instead of clashing as duplicate categories
+    eng_df["src"] = eng_df["src"].replace(SOURCE_NAMES)
     eng_df["state"] = eng_df["state"].str.upper()
 
+    #Low-cardinality labels are stored as categoricals so joins work on 
+    #integer codes
+    for col in ["state", "src"]:
+        eng_df[col] = eng_df[col].astype("category")
+
     return eng_df
 
 
-def build_eng(files=ENG):
+def build_eng(files=ENG, cache=ENG_CACHE):
     '''
     Loads, cleans, and merges both energy data sets
 
     Inputs: 
         files (lst): list of filepaths for the three data sets (constant)
-        codes (str): the filepath to the state codes data
+        cache (str): base parquet filepath for the cleaned data, or None to 
+            always rebuild
 
     Returns:
         pop_df (pandas df): a dataframe of population data from 1990-2019
     '''
-    eng_df = load_clean_eng(files[0])
-    
-    for filename in files[1:]:
-        df = load_clean_eng(filename)
-        eng_df = eng_df.merge(df, how="left", on=["state", "year", "src"])
+    eng_df = load_cache(cache, files)
+    if eng_df is not None:
+        return eng_df
+
+    keys = ["year", "state", "src"]
+    #The csv parsers release the GIL, so the large files are read concurrently
+    with ThreadPoolExecutor(max_workers=len(files)) as pool:
+        frames = list(pool.map(load_clean_eng, files))
+
+    #The loaders return the string keys as categoricals; give them shared 
+    #categories so the frames align on integer codes instead of strings
+    for key in ["state", "src"]:
+        cats = union_categoricals([df[key] for df in frames]).categories
+        for df in frames:
+            df[key] = df[key].cat.set_categories(cats)
+
+    #Every frame has one row per key, so an index join is a column-wise
+    #union restricted to the generation rows
+    frames = [df.set_index(keys) for df in frames]
+    eng_df = frames[0]
+
+    for df in frames[1:]:
+        eng_df = eng_df.join(df, how="left")
+
+    eng_df = eng_df.reset_index()
+
+    for key in ["state", "src"]:
+        eng_df[key] = eng_df[key].astype(object)
 
     eng_df.fillna(0, inplace=True) 
     eng_df = eng_df.loc[eng_df.loc[:, "state"] != "US-Total", :] 
@@ -221,6 +440,7 @@ def build_eng(files=ENG):
     eng_df = eng_df.loc[eng_df.loc[:, "state"] != "DC", :] 
 
     eng_df = eng_df.rename(columns={"state": "code"})
+    save_cache(eng_df, cache, files)
 
     return eng_df
 
@@ -237,7 +457,7 @@ def build_full():
     '''
     eng_df = build_eng()
     pop = build_pop()
-    pol = load_clean_pol()
+    pol = add_state_codes(load_clean_pol())
 
     #Merge 3 data sets together
     data = pop.merge(pol, how="left", on=["state", "code", "year"])